@@ -7,27 +7,41 @@ Simple file for converting the .txt wavefile to the standard root format.
 """
 import sipmanalyze.formats as forms
 import argparse
+import uproot
 import awkward
 import os
+from concurrent.futures import ProcessPoolExecutor
 
-std_cont = forms.standard.standard_container.from_txt('lowlight_testing.txt')
-
-std_cont.data = awkward.zip({
-  **{
-    f: std_cont.data[f]
-    for f in std_cont.data.fields if f != 'payload'
-  },  #
-  'readout': std_cont.data.payload,
-})
-print(std_cont.data.time.__repr__)
-print(std_cont.data.readout)
-print(std_cont.data.fields)
-std_cont = forms.standard.standard_container.from_root('root_format_test.root')
-print(std_cont.data.time.__repr__)
-
-print(std_cont.data.fields)
-std_cont = forms.standard.standard_container.from_root(
-  'lowlightcollect_root_test.root')
-print(std_cont.data.time.__repr__)
-print(std_cont.data.fields)
 
+def _convert(in_f):
+  try:
+    out_f = in_f.replace('.txt', '.root')
+    print(f'Converting file {in_f}')
+    std_cont = forms.standard.standard_container.from_txt(in_f)
+    # Building the record directly from the existing layouts, with the payload
+    # renamed to the readout values
+    names = [f for f in std_cont.data.fields if f != 'payload']
+    std_cont.data = awkward.Array(
+      awkward.layout.RecordArray(
+        [std_cont.data[f].layout for f in names] +
+        [std_cont.data.payload.layout], names + ['readout']))
+
+    std_cont.save_to_file(out_f, compression=uproot.LZ4(4))
+    del std_cont
+  except Exception as err:
+    print(err)
+    pass
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+    "Converting a low light file to a standard root file format.")
+  parser.add_argument('input', type=str, nargs='+', help='input .txt file')
+  parser.add_argument('-j',
+                      '--jobs',
+                      type=int,
+                      default=os.cpu_count(),
+                      help='number of files to convert in parallel')
+  args = parser.parse_args()
+  with ProcessPoolExecutor(max_workers=args.jobs) as ex:
+    list(ex.map(_convert, args.input))
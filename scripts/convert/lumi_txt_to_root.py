@@ -7,28 +7,43 @@ Simple file for converting the .txt wavefile to the standard root format.
 """
 import sipmanalyze.formats as forms
 import argparse
+import uproot
 import os
 import awkward
+from concurrent.futures import ProcessPoolExecutor
+
+
+def _convert(in_f):
+  try:
+    out_f = in_f.replace('.txt', '.root')
+    print(f'Converting file {in_f}')
+    std_cont = forms.standard.standard_container.from_txt(in_f)
+    # Building the record directly from the existing layouts, with the payload
+    # columns replaced by their named counterparts
+    payload = std_cont.data.payload
+    names = [f for f in std_cont.data.fields if f != 'payload']
+    std_cont.data = awkward.Array(
+      awkward.layout.RecordArray(
+        [std_cont.data[f].layout for f in names] +
+        [payload[:, 0].layout, payload[:, 1].layout],
+        names + ['lumival', 'uncval']))
+
+    std_cont.save_to_file(out_f, compression=uproot.LZ4(4))
+    del std_cont
+  except Exception as err:
+    print(err)
+    pass
+
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(
     "Converting a waveform file to a standard root file format.")
   parser.add_argument('input', type=str, nargs='+', help='input .txt file')
+  parser.add_argument('-j',
+                      '--jobs',
+                      type=int,
+                      default=os.cpu_count(),
+                      help='number of files to convert in parallel')
   args = parser.parse_args()
-  for idx, in_f in enumerate(args.input):
-    try:
-      out_f = in_f.replace('.txt', '.root')
-      print(f'Converting file {in_f} [{idx+1}/{len(args.input)}]')
-      std_cont = forms.standard.standard_container.from_txt(in_f)
-      std_cont.data['lumival'] = std_cont.data.payload[:, 0]
-      std_cont.data['uncval'] = std_cont.data.payload[:, 1]
-      std_cont.data = awkward.zip(
-        {f: std_cont.data[f]
-         for f in std_cont.data.fields
-         if f != 'payload'})
-
-      std_cont.save_to_file(out_f)
-      del std_cont
-    except Exception as err:
-      print(err)
-      pass
+  with ProcessPoolExecutor(max_workers=args.jobs) as ex:
+    list(ex.map(_convert, args.input))
@@ -7,20 +7,32 @@ Simple file for converting the .txt wavefile to the standard root format.
 """
 import sipmanalyze.formats as forms
 import argparse
+import uproot
 import os
+from concurrent.futures import ProcessPoolExecutor
+
+
+def _convert(in_f):
+  try:
+    out_f = in_f.replace('.txt', '.root')
+    print(f'Converting file {in_f}')
+    container = forms.waveform.waveform_container.from_txt(in_f)
+    container.save_to_file(out_f, compression=uproot.LZ4(4))
+    del container
+  except Exception as err:
+    print(err)
+    pass
+
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(
     "Converting a waveform file to a standard root file format.")
   parser.add_argument('input', type=str, nargs='+', help='input .txt file')
+  parser.add_argument('-j',
+                      '--jobs',
+                      type=int,
+                      default=os.cpu_count(),
+                      help='number of files to convert in parallel')
   args = parser.parse_args()
-  for idx, in_f in enumerate(args.input):
-    try:
-      out_f = in_f.replace('.txt', '.root')
-      print(f'Converting file {in_f} [{idx+1}/{len(args.input)}]')
-      container = forms.waveform.waveform_container.from_txt(in_f)
-      container.save_to_file(out_f)
-      del container
-    except Exception as err:
-      print(err)
-      pass
\ No newline at end of file
+  with ProcessPoolExecutor(max_workers=args.jobs) as ex:
+    list(ex.map(_convert, args.input))
@@ -4,52 +4,160 @@ estimate.py
 
 Functions to help with estimation of low-light parameters.
 
+The plotting helpers are only imported within the plot_* functions, such that
+batch jobs that only run the estimation do not load the plotting stack.
+Likewise hist and zfit (which loads tensorflow) are only imported by the
+functions that use them.
+
 """
 
-import matplotlib.pyplot as plt
 import sipmanalyze.formats as forms
 import awkward as ak
 import numpy as np
 
-import sipmanalyze.plotting as plot
-import hist
+import hashlib
+from collections import OrderedDict
+
+from scipy.optimize import curve_fit, nnls
+from scipy.special import gammaln, erf
+
+
+#- fills the counts of a regular binning with integer bin arithmetic, values on the upper edge are kept in the last bin
+#- area is the numpy array of values to bin, amin, bin_width and nbins define the regular binning
+def _bincount_regular(area, amin, bin_width, nbins):
+  idx = ((area - amin) / bin_width).astype(np.intp)
+  np.clip(idx, 0, nbins - 1, out=idx)
+  return np.bincount(idx, minlength=nbins)
+
+
+#- determines the bin width using the Freedman-Diaconis rule, returns None if the interquartile range vanishes
+#- the bin width is rounded to an integer multiple of adc_step so that the discrete readout values do not alias in the histogram
+#- min_bins is the lower limit on the number of bins covering amin to amax, the width is reduced in whole adc_step units to reach it
+def _auto_bin_width(area, amin, amax, adc_step, min_bins=32):
+  iqr = np.subtract(*np.percentile(area, [75, 25]))
+  if iqr <= 0:
+    return None
+  width = 2 * iqr * len(area)**(-1 / 3)
+  steps = min(round(width / adc_step), np.floor((amax - amin) / min_bins / adc_step))
+  return max(1, int(steps)) * adc_step
+
+
+#- results of get_peaks and gauss_estimate for the most recently used inputs, such that rerunning a notebook cell on the same histogram does not redo the fits
+_RESULT_CACHE_SIZE = 16
+_peak_cache = OrderedDict()
+_gauss_cache = OrderedDict()
+
+
+#- key identifying the binned data of import_data_results by the hash of the full bin counts and edges
+def _hist_key(import_data_results):
+  digest = hashlib.sha1(np.ascontiguousarray(import_data_results["n"]).tobytes())
+  digest.update(np.ascontiguousarray(import_data_results["edges"]).tobytes())
+  return digest.hexdigest()
 
-from scipy.signal import find_peaks
-import scipy.integrate as integrate
-from scipy.optimize import curve_fit
-from scipy.special import factorial
 
-import zfit
+#- returns a copy of the cached result dictionary for key, or None if it is not cached
+def _cache_get(cache, key):
+  if key not in cache:
+    return None
+  cache.move_to_end(key)
+  return {k: np.copy(v) for k, v in cache[key].items()}
+
+
+#- stores a copy of the result dictionary under key, dropping the least recently used entries beyond _RESULT_CACHE_SIZE
+def _cache_put(cache, key, result):
+  cache[key] = {k: np.copy(v) for k, v in result.items()}
+  cache.move_to_end(key)
+  while len(cache) > _RESULT_CACHE_SIZE:
+    cache.popitem(last=False)
+
+
+#- samples of each waveform that are summed to get the area
+_INTEGRATION_WINDOW = slice(5, 30)
+
+
+#- returns the slice of the integration window within waveforms that were read with the sample slice applied (None if the full waveforms were read)
+#- raises a ValueError if the applied slice does not contain the full integration window
+def _integration_window(applied=None):
+  if applied is None:
+    return _INTEGRATION_WINDOW
+  start = 0 if applied.start is None else applied.start
+  stop = applied.stop
+  contained = (0 <= start <= _INTEGRATION_WINDOW.start) and (stop is None or stop >= _INTEGRATION_WINDOW.stop)
+  if applied.step not in (None, 1) or not contained:
+    raise ValueError(f"waveforms read with sample_slice={applied} do not contain the integration window {_INTEGRATION_WINDOW}")
+  return slice(_INTEGRATION_WINDOW.start - start, _INTEGRATION_WINDOW.stop - start)
 
 
 #- Use this function to import the lowlight response data from a root file
-#- file_location is a string giving the location of the imported file
+#- source is either the location of the imported file (a string or path), or an already loaded waveform_container
+#   - passing the container avoids reading the root file again when the import is rerun with different settings
+#   - if the container was loaded with a sample_slice (recorded in container.sample_slice), the integration window is shifted accordingly, the slice must contain samples 5 to 30
+#- OPTIONAL: nbins is the number of histogram bins, if None the number of bins is determined automatically using the Freedman-Diaconis rule
+#- OPTIONAL: adc_per_bin is the number of ADC readout steps per histogram bin, overrides the automatic binning (the previous default was 4)
 #- import_data_results is a dictionary with the results of the import used in later functions:
 #      area: raw data
+#      n: numpy array of the bin counts
+#      centers: numpy array of the bin centers
+#      edges: numpy array of the bin edges
+#      bin_width: width of the regular bins
 #      h: histogram object filled with data
-def import_data(file_location):
-  #get data
-  container = forms.waveform.waveform_container.from_root(file_location)
+def import_data(source, nbins=None, adc_per_bin=None):
+  #get data, only the samples in the integration window are read from file
+  if isinstance(source, forms.waveform.waveform_container):
+    container = source
+  else:
+    container = forms.waveform.waveform_container.from_root(
+      source, sample_slice=_INTEGRATION_WINDOW)
+  window = _integration_window(container.sample_slice)
   tint = container.settings.timeintervals
   vadc = container.settings.adc_val
-  area = ak.sum(container.waveforms[:, 5:30], axis=-1) * tint * vadc * -1
-  amin, amax = ak.min(area), ak.max(area)
-  nbins = int((amax - amin) / tint / vadc / 4)
-  bin_width=(amax-amin)/nbins
+  scale = tint * vadc * -1
+  dense = container.waveforms_np
+  try:
+    # Waveforms typically have a fixed sample count, so the integration window
+    # can be reduced as a dense numpy array, using the container's dense array
+    # if it has one.
+    wf = dense[:, window] if dense is not None else ak.to_numpy(container.waveforms[:, window])
+    area = wf.sum(axis=1, dtype=np.float32) * np.float32(scale)
+  except ValueError:
+    # Genuinely jagged waveforms, falling back to the awkward reduction
+    area = ak.to_numpy(ak.sum(container.waveforms[:, window], axis=-1)) * scale
+    area = area.astype(np.float32)
+  amin, amax = float(area.min()), float(area.max())
+  lo, hi = amin, amax
+  bin_width = None
+  if adc_per_bin is not None:
+    nbins = int((amax - amin) / tint / vadc / adc_per_bin)
+  elif nbins is None:
+    adc_step = abs(tint * vadc)
+    bin_width = _auto_bin_width(area, amin, amax, adc_step)
+    if bin_width is None:
+      nbins = max(32, int(np.ceil(np.log2(len(area)) + 1)))  # Sturges rule
+    else:
+      #the edges are placed halfway between the readout values, and the range is extended to a whole number of bins, so that every bin holds the same number of readout values
+      lo = amin - adc_step / 2
+      nbins = int(np.ceil((amax - lo) / bin_width))
+      hi = lo + nbins * bin_width
+  if bin_width is None:
+    bin_width=(hi-lo)/nbins
     
-  #bin data in histogram
-  axis=hist.axis.Regular(nbins, amin, amax, name='r')
+  #bin data, the histogram object is only kept for plotting
+  import hist
+  n = _bincount_regular(area, lo, bin_width, nbins)
+  axis=hist.axis.Regular(nbins, lo, hi, name='r')
   h = hist.Hist(axis)
-  h.fill(area)
+  h.view()[:] = n
     
   #save data in dict
-  import_data_results={"area":area,"h":h}
+  import_data_results={"area":area,"n":n,"centers":axis.centers,"edges":axis.edges,"bin_width":bin_width,"h":h}
   return import_data_results
 
 #- use this function to plot the results of importing the data
 #- import_data_results is the dictionary of results returned by import_data
 #- fig, ax are the figure and axis respectively of the plot so the user may make further edits to the plot
 def plot_import_data(import_data_results):
+  import sipmanalyze.plotting as plot
+
   #import histogram data
   h=import_data_results["h"]
   
@@ -64,7 +172,31 @@ def plot_import_data(import_data_results):
   return fig, ax
 
 
-#- Use this function to determine the location of the peaks in the data, uses https://docs.scipy.org/doc/scipy/reference/generated/scipy.signal.find_peaks.html
+#- finds the local maxima of the bin counts n with the height and distance conditions of https://docs.scipy.org/doc/scipy/reference/generated/scipy.signal.find_peaks.html
+#- flat maxima are reported at the middle bin, and of peaks closer than distance bins only the highest is kept
+#- returns the numpy array of the bin numbers of the peaks
+def _find_peaks(n, height, distance):
+  #run length encoding of the counts, such that a plateau is a single run
+  starts=np.concatenate(([0], np.flatnonzero(np.diff(n)!=0)+1))
+  ends=np.append(starts[1:], len(n))-1
+  values=n[starts]
+  
+  #runs higher than both neighbouring runs, runs touching the histogram edges are never peaks
+  is_max=np.zeros(len(starts), dtype=bool)
+  is_max[1:-1]=(values[1:-1]>values[:-2]) & (values[1:-1]>values[2:])
+  peaks=(starts[is_max]+ends[is_max])//2
+  peaks=peaks[n[peaks]>=height]
+  
+  #go through the peaks from highest to lowest and drop the lower peaks within distance of each kept peak, ties are ordered as in scipy
+  distance=np.ceil(distance)
+  keep=np.ones(len(peaks), dtype=bool)
+  for i in np.argsort(n[peaks].astype(float))[::-1]:
+    if keep[i]:
+      keep[np.abs(peaks-peaks[i])<distance]=False
+      keep[i]=True
+  return peaks[keep]
+
+#- Use this function to determine the location of the peaks in the data, the peak finding follows https://docs.scipy.org/doc/scipy/reference/generated/scipy.signal.find_peaks.html
 #- import_data_results is the dictionary of results returned by import_data
 #- min_gain_guess is the minimum gain expected and helps to avoid extraneous peaks that are too close to each other
 #- min_ratio_guess is the minimum height of a peak allowed as a ratio of the highest peak, ensures that tiny fluctutions in the data aren't labeled as peaks
@@ -78,20 +210,24 @@ def get_peaks(import_data_results, min_gain_guess=80, min_ratio_guess=1/20):
   if min_ratio_guess<0 or min_ratio_guess >1:
     raise Exception("min_ratio_guess must be from 0 to 1, current value is ",min_ratio_guess)
  
+  #reuse the results if the same histogram was already processed with the same settings
+  key=(_hist_key(import_data_results), min_gain_guess, min_ratio_guess)
+  peak_results=_cache_get(_peak_cache, key)
+  if peak_results is not None:
+    return peak_results
+ 
   #import data
-  h=import_data_results["h"]
-  n, _= h.to_numpy()
-  axis=h.axes[0]
-  bin_centers=axis.centers
-  nbins=len(bin_centers)
-  bin_width=(axis.edges[-1]-axis.edges[0])/nbins
+  n=import_data_results["n"]
+  bin_centers=import_data_results["centers"]
+  bin_width=import_data_results["bin_width"]
   
   #get peaks in data
   min_distance=min_gain_guess/bin_width
   max_occurences=max(n)
-  peak_bin_numbers, properties=find_peaks(n,height=max_occurences*min_ratio_guess,distance=min_distance)
+  peak_bin_numbers=_find_peaks(n,height=max_occurences*min_ratio_guess,distance=min_distance)
   peaks=bin_centers[peak_bin_numbers]
   peak_results={"peak_bin_numbers":peak_bin_numbers,"peaks":peaks} 
+  _cache_put(_peak_cache, key, peak_results)
   
   return peak_results
 
@@ -100,9 +236,11 @@ def get_peaks(import_data_results, min_gain_guess=80, min_ratio_guess=1/20):
 #- peak_results is the dictionary of results returned by get_peaks
 #- fig, ax are the figure and axis respectively of the plot so the user may make further edits to the plot
 def plot_peak_results(import_data_results,peak_results):
+  import sipmanalyze.plotting as plot
+
   #import data
   h=import_data_results["h"] 
-  n, _= h.to_numpy() 
+  n=import_data_results["n"]
   peaks=peak_results["peaks"]
   peak_bin_numbers=peak_results["peak_bin_numbers"]
 
@@ -121,9 +259,26 @@ def plot_peak_results(import_data_results,peak_results):
 
   return fig, ax
 
+#constants used by the gaussian helper functions
+_SQRT2=np.sqrt(2)
+_SQRT_HALF_PI=np.sqrt(np.pi/2)
+
 #gauss function used for fitting gaussian peaks
 def gauss(x, a, x0, sigma):
-    return a*np.exp(-(x-x0)**2/(2*sigma**2))
+    return a*np.exp((x-x0)**2*(-0.5/sigma**2))
+
+#jacobian of the gauss function with respect to (a, x0, sigma), passed to curve_fit to avoid finite differences
+def gauss_jac(x, a, x0, sigma):
+    d = x-x0
+    inv_s2 = 1/sigma**2
+    e = np.exp(d**2*(-0.5*inv_s2))
+    ae_d = a*e*d*inv_s2
+    return np.stack([e, ae_d, ae_d*d/sigma], axis=-1)
+
+#closed form integral of the gauss function from lo to hi
+def gauss_integral(lo, hi, a, x0, sigma):
+    s = sigma*_SQRT2
+    return a*sigma*_SQRT_HALF_PI*(erf((hi-x0)/s)-erf((lo-x0)/s))
 
 #- use this function to fit gaussian curves to each of the peaks in the data using curve_fit https://docs.scipy.org/doc/scipy/reference/generated/scipy.optimize.curve_fit.html
 #- import_data_results is the dictionary of results returned by import_data
@@ -135,58 +290,77 @@ def gauss(x, a, x0, sigma):
 #     mu: the mean value of the gaussian curve
 #     sigma: the standard deviation of the gaussian curve
 #     a: the factor on the gaussian curve that determines the height of the curve
-#     x_part: the list of x-locations in mv-ns which were passed to each gaussian fit to determine the curve.
+#     x_part: 2D array of the x-locations in mv-ns which were passed to each gaussian fit to determine the curve, windows clipped by the histogram edges are padded with nan
 def gauss_estimate(import_data_results, peak_results, gauss_width=10):
   #error testing
   if gauss_width<=0 or not isinstance(gauss_width,int):
     raise Exception("gauss_width must be an integer greater than 0, current value is ",gauss_width)
     
+  #reuse the results if the same histogram and peaks were already fitted with the same settings
+  key=(_hist_key(import_data_results),
+       np.asarray(peak_results["peak_bin_numbers"]).tobytes(),
+       np.asarray(peak_results["peaks"]).tobytes(),
+       gauss_width)
+  gauss_dict=_cache_get(_gauss_cache, key)
+  if gauss_dict is not None:
+    return gauss_dict
+    
   #import data
-  area=import_data_results["area"]
-  h=import_data_results["h"]
-  axis=h.axes[0]
-  amax=axis.edges[-1]
-  amin=axis.edges[0]
-  bin_centers=axis.centers
+  n=import_data_results["n"]
+  bin_centers=import_data_results["centers"]
   nbins=len(bin_centers)
-  bin_width=(axis.edges[-1]-axis.edges[0])/nbins
-  n, _= h.to_numpy()
+  bin_width=import_data_results["bin_width"]
     
   peak_bin_numbers=peak_results["peak_bin_numbers"]
   peaks=peak_results["peaks"]
 
-  gauss_dict={"peak":[],"mu":[],"sigma":[],"integral":[],"a":[],"x_part":[]}
-  x = np.linspace(amin+bin_width/2, amax-bin_width/2, nbins)
+  x = bin_centers
   
-  #loop through each peak to attempt to fit gaussian to each
-  for idpeak, peak_bin_number in enumerate(peak_bin_numbers):
-    #set limits for what data gets passed to each gaussian fitting for each peak
-    gauss_width=gauss_width
-    min_bin=peak_bin_number-gauss_width
-    if(min_bin<0):
-      min_bin=0
-    max_bin=peak_bin_number+gauss_width+1
-    if(max_bin>(nbins-1)):
-      max_bin=nbins-1
-    x_part=x[min_bin:max_bin]
-    n_part=n[min_bin:max_bin]
-
-    #fit gaussian curve
-    popt, _ = curve_fit(gauss, x_part, n_part,p0=[10000,peaks[idpeak],50])
- 
-    #results from gaussian fit
-    a=popt[0]
-    x0=popt[1]
-    sigma=popt[2]
-
-    # Only save data from good gaussian fits
-    if abs(x0-peaks[idpeak])<=5*bin_width and sigma<=10*bin_width:
-      gauss_dict["integral"].append(integrate.quad(lambda z:gauss(z,a,x0,sigma),x_part[0],x_part[-1])[0])
-      gauss_dict["peak"].append(peaks[idpeak])
-      gauss_dict["mu"].append(x0)
-      gauss_dict["sigma"].append(sigma)
-      gauss_dict["a"].append(a)
-      gauss_dict["x_part"].append(x_part)
+  #set limits for what data gets passed to each gaussian fitting for each peak
+  min_bins=np.maximum(peak_bin_numbers-gauss_width, 0)
+  max_bins=np.minimum(peak_bin_numbers+gauss_width+1, nbins-1)
+
+  #gather the windows of all peaks as (npeaks, 2*gauss_width+1) matrices, entries outside of the limits are masked
+  index=peak_bin_numbers[:, None]+np.arange(-gauss_width, gauss_width+1)
+  valid=(index>=min_bins[:, None]) & (index<max_bins[:, None])
+  np.clip(index, 0, nbins-1, out=index)
+  X=x[index]
+  Y=n[index]
+  x_parts=np.where(valid, X, np.nan)
+
+  #initial guess of the gaussian parameters from the weighted moments of each window
+  W=np.where(valid, Y, 0).astype(float)
+  tot=W.sum(axis=1)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    mu0=(X*W).sum(axis=1)/tot
+    sigma0=np.sqrt(((X-mu0[:, None])**2*W).sum(axis=1)/tot)
+  npeaks=len(peak_bin_numbers)
+  p0s=np.stack([W.max(axis=1), mu0, np.maximum(sigma0, bin_width)], axis=-1)
+  fallback=np.stack([np.full(npeaks, 10000.), peaks, np.full(npeaks, 50.)], axis=-1)
+  p0s=np.where((tot>0)[:, None], p0s, fallback)
+
+  #loop through each peak to fit a gaussian to each, the windows are small so individual fits are cheaper than one joint fit
+  popts=np.empty((npeaks, 3))
+  for idpeak in range(npeaks):
+    rows=valid[idpeak]
+    popts[idpeak], _ = curve_fit(gauss, X[idpeak, rows], Y[idpeak, rows], p0=p0s[idpeak], jac=gauss_jac)
+
+  #results from gaussian fits
+  a=popts[:, 0]
+  x0=popts[:, 1]
+  sigma=popts[:, 2]
+
+  # Only save data from good gaussian fits
+  accepted=(np.abs(x0-peaks)<=5*bin_width) & (sigma<=10*bin_width)
+  gauss_dict={
+    "integral":gauss_integral(x[min_bins], x[max_bins-1], a, x0, sigma)[accepted],
+    "peak":peaks[accepted],
+    "mu":x0[accepted],
+    "sigma":sigma[accepted],
+    "a":a[accepted],
+    "x_part":x_parts[accepted],
+  }
+  _cache_put(_gauss_cache, key, gauss_dict)
     
   return gauss_dict
 
@@ -195,6 +369,9 @@ def gauss_estimate(import_data_results, peak_results, gauss_width=10):
 #- gauss_dict is the dictionary of results returned by gauss_estimate
 #- fig, ax are the figure and axis respectively of the plot so the user may make further edits to the plot
 def plot_gauss_estimate(import_data_results,gauss_dict):
+  import sipmanalyze.plotting as plot
+  from matplotlib.collections import LineCollection
+
   #import data
   h=import_data_results["h"]
   
@@ -202,9 +379,13 @@ def plot_gauss_estimate(import_data_results,gauss_dict):
   fig,ax = plot.make_simple_figure() 
   plot.plot_data1d(ax=ax, data=h, label='Data', histtype='fill')  
   
-  #plot gaussians
-  for idpeak, peak in enumerate(gauss_dict["peak"]):
-    ax.plot(gauss_dict["x_part"][idpeak], gauss(gauss_dict["x_part"][idpeak],gauss_dict["a"][idpeak],gauss_dict["mu"][idpeak],gauss_dict["sigma"][idpeak]), label='Fit of Peak at '+str(int(peak)))
+  #plot gaussians as a single collection with one segment per peak, the nan padding of x_part is not drawn
+  x_part=gauss_dict["x_part"]
+  y=gauss(x_part, gauss_dict["a"][:, None], gauss_dict["mu"][:, None], gauss_dict["sigma"][:, None])
+  fits=LineCollection(np.stack([x_part, y], axis=-1),
+                      colors=[f'C{idpeak+1}' for idpeak in range(len(x_part))],
+                      label='Gaussian fits of peaks')
+  ax.add_collection(fits)
   plot.add_std_label(ax=ax, label='Preliminary', rlabel='Gaussian Estimation')
   ax.set_xlabel('Readout [mV-ns]')
   ax.set_ylabel('Number of events')
@@ -215,11 +396,10 @@ def plot_gauss_estimate(import_data_results,gauss_dict):
 #- this function determines the estimated vaue of pedestal and gain based on the gaussian curve fits
 #- gauss_dict is the dictionary of results returned by gauss_estimate
 def pedestal_gain_est(gauss_dict):
-  #function which determines the relationship between pedestal, gain, and the mean values of the gaussians
-  def linear(z,pedestal,gain):
-    return pedestal+z*gain
-  #fit mean values of gaussians to function
-  popt, popc = curve_fit(linear, range(len(gauss_dict["mu"])), gauss_dict["mu"])
+  #the mean values of the gaussians are linear in the pedestal and the gain, mu = pedestal + z*gain, so the fit is a linear least squares solve
+  z=np.arange(len(gauss_dict["mu"]), dtype=float)
+  A=np.stack([np.ones_like(z), z], axis=-1)
+  popt, *_ = np.linalg.lstsq(A, gauss_dict["mu"], rcond=None)
   
   #save data
   pedestal_est=popt[0]
@@ -233,9 +413,21 @@ def common_pixel_noise_est(gauss_dict):
   #function which determines the relationship between the common noise, the pixel noise, and the gaussian standard deviation
   def noise(z,common_noise,pixel_noise):
     return np.sqrt(common_noise*common_noise+z*pixel_noise*pixel_noise)
+  def noise_jac(z,common_noise,pixel_noise):
+    s=noise(z,common_noise,pixel_noise)
+    return np.stack([common_noise/s, z*pixel_noise/s], axis=-1)
+
+  #the gaussian variances are linear in the squared noise terms, sigma^2 = common_noise^2 + z*pixel_noise^2, so a non-negative linear least squares solve gives the starting point of the fit
+  #each row is weighted by 1/sigma, such that the residuals are those of the standard deviations to first order
+  sigma=np.asarray(gauss_dict["sigma"], dtype=float)
+  z=np.arange(len(sigma), dtype=float)
+  A=np.stack([np.ones_like(z), z], axis=-1)/sigma[:, None]
+  p0, _ = nnls(A, sigma)
+  #the starting point is kept strictly within the bounds, a vanishing noise term is a degenerate point of the fit function
+  p0=np.clip(np.sqrt(p0), 1e-1, 100-1e-1)
 
   #fit function to gaussian standard deviations
-  popt, popc = curve_fit(noise,range(len(gauss_dict["sigma"])),gauss_dict["sigma"],bounds=(0,100))
+  popt, popc = curve_fit(noise,z,sigma,p0=p0,bounds=(0,100),jac=noise_jac)
   
   #save data
   common_noise_est=popt[0]
@@ -246,17 +438,25 @@ def common_pixel_noise_est(gauss_dict):
 #- this function determines the estimated vaue of the poisson mean and the poisson borel based on the gaussian curve fits
 #- gauss_dict is the dictionary of results returned by gauss_estimate
 def poisson_mean_borel_est(gauss_dict):
+  #number of discharged pixels of each gaussian peak, and the log(z!) values used by the fit function
+  z=np.arange(len(gauss_dict["integral"]))
+  log_fact=gammaln(z+1)
+
   #function which determines the relationship between the poisson mean, the poisson borel, the number of events, and the number of events under each gaussian curve
   def height(z,N,mu,l):
     y=(mu+(z*l))
-    result=np.exp(-np.log(factorial(z))+np.log(mu)+np.log(N)+(z-1)*np.log(y)-y)
+    result=np.exp(-log_fact+np.log(mu)+np.log(N)+(z-1)*np.log(y)-y)
     return result
+  def height_jac(z,N,mu,l):
+    y=(mu+(z*l))
+    h=height(z,N,mu,l)
+    return np.stack([h/N, h*(1/mu+(z-1)/y-1), h*(z*(z-1)/y-z)], axis=-1)
   
   #used to scale the gaussian to the correct size by setting the value of N instead of using fractional probabilities
   integrals_total=sum(gauss_dict["integral"])
   
   #fit integral values to the function
-  popt, popc = curve_fit(height,np.arange(stop=len(gauss_dict["integral"]),step=1),gauss_dict["integral"],p0=(integrals_total,2.5,.05),bounds=([integrals_total-50000,.1,0],[integrals_total+50000,5,.2]))
+  popt, popc = curve_fit(height,z,gauss_dict["integral"],p0=(integrals_total,2.5,.05),bounds=([integrals_total-50000,.1,0],[integrals_total+50000,5,.2]),jac=height_jac)
   
   #saving data
   poisson_mean_est=popt[1]
@@ -275,29 +475,41 @@ def poisson_mean_borel_est(gauss_dict):
 #     upper_bound: the upper bound passed to zfit to try while fitting
 #     lower_bound: the lower bound passed to zfit to try while fitting
 def set_bounds(variable_estimates,limits_dict):
-  for key, value in variable_estimates.items():
-    #error testing
+  #error testing
+  for key in variable_estimates:
     if key not in limits_dict:
       raise Exception("The variable ",key,"is not in the limits_dict")
     if "width" not in limits_dict[key]:
       raise Exception("The width is not set in limits_dict for the variable ",key)
     if limits_dict[key]["width"] <=0:
       raise Exception("width <= 0 in limits_dict for the variable ",key)
-    
-    #calculate correct bounds
-    lower_bound=value-limits_dict[key]["width"]
-    upper_bound=value+limits_dict[key]["width"]
-    if "lower_max" in limits_dict[key]:
-      if lower_bound < limits_dict[key]["lower_max"]:
-        lower_bound= limits_dict[key]["lower_max"]
-    if "upper_max" in limits_dict[key]:
-      if upper_bound > limits_dict[key]["upper_max"]:
-          upper_bound=limits_dict[key]["upper_max"]
+  
+  #calculate correct bounds for all variables at once, a missing logical limit does not restrict the bounds
+  keys=list(variable_estimates)
+  values=np.array([variable_estimates[key] for key in keys], dtype=float)
+  widths=np.array([limits_dict[key]["width"] for key in keys], dtype=float)
+  lower_max=np.array([limits_dict[key].get("lower_max", -np.inf) for key in keys], dtype=float)
+  upper_max=np.array([limits_dict[key].get("upper_max", np.inf) for key in keys], dtype=float)
+  lower_bounds=np.maximum(values-widths, lower_max)
+  upper_bounds=np.minimum(values+widths, upper_max)
+  for key, lower_bound, upper_bound in zip(keys, lower_bounds.tolist(), upper_bounds.tolist()):
     limits_dict[key]["upper_bound"]=upper_bound
     limits_dict[key]["lower_bound"]=lower_bound
   
   return limits_dict
 
+#- bins the imported area data for the binned pdf fits
+#- obs is the zfit observable of the unbinned pdf
+#- import_data_results is the output of the function import_data
+#- returns the binned zfit space and the binned zfit data
+def _binned_data(obs, import_data_results):
+  import zfit
+  binning = zfit.binned.RegularBinning(400, -200, 1500, name="x")
+  obs_bin = zfit.Space("x", binning=binning)
+  data_unbinned = zfit.Data.from_numpy(obs=obs, array=np.asarray(import_data_results["area"]))
+  data_bin = data_unbinned.to_binned(obs_bin) 
+  return obs_bin, data_bin
+
 #- This function takes the pdf and runs an iterative pdf fit to ensure no variables hit the upper or lower bounds
 #- pdf is the zfit probability distribution function
 #- parameters is a dictionary of the zfit parameters with their names as the key and the parameters as the values
@@ -307,6 +519,8 @@ def set_bounds(variable_estimates,limits_dict):
 #- OPTIONAL: message is an optional bool usually set to false which can give messages relating to the final state of the fit
 #- returns zfit result and zfit pdf
 def run_iterative_pdf_fit(pdf,parameters,obs,max_iterations,limits_dict,import_data_results,message=False):
+  import zfit
+
   #error testing
   if max_iterations <=0 or not isinstance(max_iterations,int):
     raise Exception("max_iterations must be a positive integer")
@@ -320,22 +534,19 @@ def run_iterative_pdf_fit(pdf,parameters,obs,max_iterations,limits_dict,import_d
     if limits_dict[key]["lower_bound"]>limits_dict[key]["upper_bound"]:
       raise Exception("Illogical bounds for ",key," upper_bound is ",limits_dict[key]["upper_bound"]," lower_bound is ",limits_dict[key]["lower_bound"])
     
-  #set up pdf
-  binning = zfit.binned.RegularBinning(400, -200, 1500, name="x")
-  obs_bin = zfit.Space("x", binning=binning)
-  data_unbinned = zfit.Data.from_numpy(obs=obs, array=np.array(import_data_results["area"]))
-  data_bin = data_unbinned.to_binned(obs_bin) 
+  #set up pdf, the binned pdf and the minimizer are reused for each iteration as only the parameter bounds change
+  obs_bin, data_bin = _binned_data(obs, import_data_results)
+  pdf_bin = zfit.pdf.BinnedFromUnbinnedPDF(pdf, obs_bin)
+  minimizer = zfit.minimize.Minuit()
   
   #iterate to run pdf and then determine if it should be rerun and set the new upper and lower bounds
   run_fitting=False
   at_logical_limit=[]
   for i in range(max_iterations):
     run_fitting=False
-    pdf_bin = zfit.pdf.BinnedFromUnbinnedPDF(pdf, obs_bin)
+    #the loss is rebuilt, as a reused loss returns nan gradients once the parameter limits change
     nll_bin = zfit.loss.BinnedNLL(pdf_bin, data_bin)
-    minimizer = zfit.minimize.Minuit()
     result = minimizer.minimize(nll_bin)
-    result.hesse()
     
     #Determine if the last run is a good fit and don't run extra unnecessary code and make output statements for each
     if i == max_iterations-1:
@@ -351,11 +562,15 @@ def run_iterative_pdf_fit(pdf,parameters,obs,max_iterations,limits_dict,import_d
     
     at_logical_limit=[]
     
+    #errors used to decide on expanding the bounds, the approximate hessian of the minimizer is used as these fits are rerun anyway
+    if any(bool(parameter.at_limit) for parameter in parameters.values()):
+      result.hesse(method="approx", name="approx_hesse")
+    
     #loop through parameters to test if any of them hit a limit, and if so expand the bounds as reasonable
     for name,parameter in parameters.items():
       if parameter.at_limit:
         value=result.params[parameter]["value"]
-        error=result.params[parameter]["hesse"]["error"]
+        error=result.params[parameter]["approx_hesse"]["error"]
         upper_error=value+error
         lower_error=value-error
         
@@ -401,6 +616,9 @@ def run_iterative_pdf_fit(pdf,parameters,obs,max_iterations,limits_dict,import_d
     if run_fitting==False:
       break
   
+  #full hesse errors only for the final result
+  result.hesse()
+  
   #at end of run message if any variables hit a logical limit
   if len(at_logical_limit)>0 and message:
         print("The following parameters reached a logical limit ")
@@ -408,4 +626,70 @@ def run_iterative_pdf_fit(pdf,parameters,obs,max_iterations,limits_dict,import_d
           print("parameter: "+str(name)+" value: "+str(result.params[parameters[name]]["value"])+" upper_bound: "+str(limits_dict[name]["upper_bound"])+" lower_bound: "+str(limits_dict[name]["lower_bound"]))  
 
   return result, pdf
-  
+
+#- This function takes the pdf and runs a single pdf fit where the logical limits are enforced by a penalty instead of by bounds
+#   - the parameters are left unbounded during the fit, so no refitting with expanded bounds is needed
+#   - the penalty is soft, so the pdf is evaluated slightly past the logical limits during the fit
+#   - crossing upper_max or lower_max of a parameter adds penalty_strength*(number of events)*((distance past the limit)/width)^2 to the negative log likelihood
+#- pdf is the zfit probability distribution function
+#- parameters is a dictionary of the zfit parameters with their names as the key and the parameters as the values
+#- limits dict is a dictionary with the "width" and the optional "upper_max" and "lower_max" of each parameter, as used by the set_bounds function
+#- import_data_results is the output of the function import_data
+#- OPTIONAL: penalty_strength is the scale of the penalty on the logical limits, the penalty is scaled with the number of events like the negative log likelihood
+#- OPTIONAL: message is an optional bool usually set to false which can give messages relating to the final state of the fit
+#- returns zfit result and zfit pdf, the parameters are left without bounds after the fit
+def run_penalized_pdf_fit(pdf,parameters,obs,limits_dict,import_data_results,penalty_strength=1,message=False):
+  import zfit
+
+  #error testing
+  if penalty_strength <=0:
+    raise Exception("penalty_strength must be greater than 0, current value is ",penalty_strength)
+  for key in parameters:
+    if key not in limits_dict:
+      raise Exception("The parameter ",key,"is not in the limits_dict, ensure the limits are set properly")
+    if "width" not in limits_dict[key]:
+      raise Exception("The width is not set in limits_dict for the variable ",key)
+    if limits_dict[key]["width"] <=0:
+      raise Exception("width <= 0 in limits_dict for the variable ",key)
+
+  #remove the bounds of the parameters, the logical limits are handled by the penalty
+  for parameter in parameters.values():
+    parameter.lower=None
+    parameter.upper=None
+
+  #penalty on the distance past the logical limits in units of the width of each parameter
+  def penalty():
+    result=0
+    for name,parameter in parameters.items():
+      width=limits_dict[name]["width"]
+      if "upper_max" in limits_dict[name]:
+        result+=zfit.z.numpy.maximum(parameter-limits_dict[name]["upper_max"],0)**2/width**2
+      if "lower_max" in limits_dict[name]:
+        result+=zfit.z.numpy.maximum(limits_dict[name]["lower_max"]-parameter,0)**2/width**2
+    return penalty_strength*len(import_data_results["area"])*result
+  penalty_constraint = zfit.constraint.SimpleConstraint(penalty, params=list(parameters.values()))
+
+  #set up pdf, the penalty is added to the negative log likelihood as a constraint
+  obs_bin, data_bin = _binned_data(obs, import_data_results)
+  pdf_bin = zfit.pdf.BinnedFromUnbinnedPDF(pdf, obs_bin)
+  nll_bin = zfit.loss.BinnedNLL(pdf_bin, data_bin, constraints=penalty_constraint)
+
+  #single fit of the penalized negative log likelihood
+  minimizer = zfit.minimize.Minuit()
+  result = minimizer.minimize(nll_bin)
+  result.hesse()
+
+  #check the fitted values against the logical limits
+  past_logical_limit=[]
+  for name,parameter in parameters.items():
+    value=result.params[parameter]["value"]
+    if "upper_max" in limits_dict[name] and value>limits_dict[name]["upper_max"]:
+      past_logical_limit.append(name)
+    if "lower_max" in limits_dict[name] and value<limits_dict[name]["lower_max"]:
+      past_logical_limit.append(name)
+  if len(past_logical_limit)>0 and message:
+    print("The following parameters were fitted past a logical limit, consider increasing penalty_strength")
+    for name in past_logical_limit:
+      print("parameter: "+str(name)+" value: "+str(result.params[parameters[name]]["value"])+" upper_max: "+str(limits_dict[name].get("upper_max"))+" lower_max: "+str(limits_dict[name].get("lower_max")))
+
+  return result, pdf
@@ -34,7 +34,12 @@ class standard_container:
 
   @staticmethod
   def from_txt(filename):
-    arr = numpy.genfromtxt(filename, dtype=numpy.float32)
+    try:
+      # Fast C-level parser for well formed, whitespace separated columns
+      arr = numpy.loadtxt(filename, dtype=numpy.float32, ndmin=2)
+    except ValueError:
+      # Slower parser that is tolerant to missing entries
+      arr = numpy.genfromtxt(filename, dtype=numpy.float32)
     if arr.shape[1] == 5:
       # Old style format with only 5 columns and readout data
       blank = awkward.zeros_like(arr[:, 0])
@@ -81,7 +86,11 @@ class standard_container:
 
       return standard_container(runinfo=standard_runinfo(test='none'), data=data)
 
-  def save_to_file(self, filename: str) -> None:
-    with uproot.recreate(filename) as f:
+  def save_to_file(
+      self,
+      filename: str,
+      compression: uproot.compression.Compression = uproot.ZLIB(1)
+  ) -> None:
+    with uproot.recreate(filename, compression=compression) as f:
       #f['run_info'] = {k: v for k, v in self.runinfo.__dict__.items()}
       f['DataTree'] = {field: self.data[field] for field in self.data.fields}
@@ -12,7 +12,7 @@ data formats to be loaded in without the need for a predefined structure. The
 return of these `from_` functions will typically be either awkward arrays.
 
 """
-from typing import Dict, Union, List
+from typing import Dict, Union, List, Optional
 from dataclasses import dataclass
 
 import textwrap
@@ -34,12 +34,64 @@ class waveform_settings:
 
 
 __adc_dtype_dict__ = {2: numpy.int8, 4: numpy.int16, }
+__adc_raw_dtype_dict__ = {2: numpy.dtype('i1'), 4: numpy.dtype('>i2'), }
+
+
+def _dense_waveforms(waveforms: awkward.Array) -> Optional[numpy.ndarray]:
+  """
+  Getting the dense (N, S) numpy array of waveforms that all have the same
+  sample count, or None if the waveforms are jagged or lazily read (converting
+  those would read all waveforms from file).
+  """
+  if isinstance(waveforms.layout, awkward.partition.PartitionedArray):
+    return None
+  try:
+    dense = awkward.to_numpy(waveforms)
+  except ValueError:  # Genuinely jagged waveforms
+    return None
+  return dense if dense.ndim == 2 else None
+
+
+def _densify(waveforms: awkward.Array):
+  """
+  Getting the dense (N, S) numpy array of the waveforms (see
+  `_dense_waveforms`). For regular waveforms the returned awkward array is
+  rebuilt on top of the dense array, so both share a single buffer.
+  """
+  dense = _dense_waveforms(waveforms)
+  if dense is None:
+    return waveforms, None
+  return awkward.from_regular(awkward.from_numpy(dense)), dense
 
 
 @dataclass
 class waveform_container:
+  """
+  Container of the readout settings and the waveforms. If only some of the
+  samples of each waveform were read (see `from_root`), the applied slice is
+  kept in `sample_slice`.
+  """
   settings: waveform_settings
   waveforms: awkward
+  sample_slice: Optional[slice] = None
+
+  @property
+  def waveforms_np(self) -> Optional[numpy.ndarray]:
+    """
+    The waveforms as a dense (N, S) numpy array when all waveforms have the
+    same sample count, otherwise None. The array is derived from `waveforms`
+    and cached for the current `waveforms` object, so it always matches the
+    waveforms, including after `waveforms` is reassigned. For the containers
+    made by the `from_` functions it shares memory with `waveforms`.
+    """
+    cache = getattr(self, '_waveforms_np_cache', None)
+    if cache is None or cache[0] is not self.waveforms:
+      self._set_waveforms_np(_dense_waveforms(self.waveforms))
+    return self._waveforms_np_cache[1]
+
+  def _set_waveforms_np(self, dense: Optional[numpy.ndarray]) -> None:
+    """Caching the dense array of the current waveforms"""
+    self._waveforms_np_cache = (self.waveforms, dense)
 
   @staticmethod
   def from_txt(filepath: str):
@@ -70,40 +122,122 @@ class waveform_container:
 
 
       """Processing the Waveforms"""
-      def convert_line(line, idx):
-        print(f'\rRunning events {idx}...', end='')
-        return numpy.array([
-          int(line[i:i + settings.adc_bits], 16)  # Folding the results
-          for i in range(0, len(line), settings.adc_bits)
-        ]).astype(__adc_dtype_dict__[settings.adc_bits])
+      def convert_line(line):
+        # Each sample is adc_bits hex digits of a big-endian two's complement
+        # value, so the decoded bytes can be viewed directly as signed integers.
+        raw_dtype = __adc_raw_dtype_dict__[settings.adc_bits]
+        nfull = len(line) - len(line) % settings.adc_bits
+        samples = numpy.frombuffer(bytes.fromhex(line[:nfull]), dtype=raw_dtype)
+        if nfull == len(line):
+          return samples
+        # Lines cut short (ex: the last event of an interrupted run) end with a
+        # partial sample, which is read from the remaining digits alone.
+        tail = numpy.array([int(line[nfull:], 16)]).astype(raw_dtype)
+        return numpy.concatenate([samples, tail])
+
+      # A first pass over the file only checks the line lengths, for waveforms
+      # of fixed length the second pass decodes each line directly into a
+      # single preallocated dense block, so neither the text lines nor the
+      # per-line arrays have to be held in memory.
+      raw_dtype = __adc_raw_dtype_dict__[settings.adc_bits]
+      dtype = __adc_dtype_dict__[settings.adc_bits]
+      start = f.tell()
+      nchars = numpy.array([len(line.strip()) for line in f], dtype=numpy.int64)
+      f.seek(start)
+      dense = None
+      if len(nchars) > 0 and nchars[0] > 0 and nchars[
+          0] % settings.adc_bits == 0 and numpy.all(nchars == nchars[0]):
+        nlines, nsamples = len(nchars), nchars[0] // settings.adc_bits
+        dense = numpy.empty((nlines, nsamples), dtype=dtype)
+        try:
+          for i, line in enumerate(f):
+            dense[i] = convert_line(line.strip())
+        except ValueError:  # Lines with embedded whitespace
+          dense = None
+          f.seek(start)
+
+      if dense is not None:
+        # The regular dimension is converted to a var dimension to keep the
+        # same type as the jagged inputs.
+        waveforms = awkward.from_regular(awkward.from_numpy(dense))
+      else:
+        # The awkward array is built once from the flat samples and the
+        # per-event sample counts.
+        samples = [convert_line(line.strip()) for line in f]
+        counts = numpy.array([len(x) for x in samples], dtype=numpy.int64)
+        flat = numpy.concatenate(samples) if samples else numpy.empty(
+          0, dtype=raw_dtype)
+        waveforms = awkward.unflatten(flat.astype(dtype), counts)
+
+      container = waveform_container(settings=settings, waveforms=waveforms)
+      container._set_waveforms_np(dense)
+      return container
 
-      waveforms = awkward.values_astype(
-        awkward.Array(
-          [convert_line(line.strip(), idx + 1) for idx, line in enumerate(f)]),
-        __adc_dtype_dict__[settings.adc_bits])
-      print(waveforms.__repr__)
+  @staticmethod
+  def from_root(filename: str,
+                sample_slice: Optional[slice] = None,
+                step_size: Union[int, str] = '100 MB',
+                lazy: bool = False):
+    """
+    Getting the waveform data from the standard ROOT file format.
 
-      return waveform_container(settings=settings, waveforms=waveforms)
+    Only the `waveforms` branch is read from the data tree. If `sample_slice` is
+    given, the waveforms are read in chunks of `step_size` and only the
+    requested samples of each waveform are kept, so the full waveforms never
+    need to be held in memory at once.
 
-  @staticmethod
-  def from_root(filename: str):
+    If `lazy` is set and no `sample_slice` is given, the waveforms are returned
+    as an `uproot.lazy` array that reads the `step_size` partitions from file
+    only when they are accessed, so no waveforms are read when the container
+    is made. No dense `waveforms_np` copy is made in this case.
+    """
     with uproot.open(filename) as f:
       # Making settings
       settings = f['run_info/readout'].arrays()
       settings = waveform_settings(
         **{name: settings[name][0]
            for name in settings.fields})
-      waveforms = f['DataTree'].arrays()['waveforms']
-
-      return waveform_container(settings=settings, waveforms=waveforms)
-
-  def save_to_file(self, filename: str) -> None:
+      tree = f['DataTree']
+      if sample_slice is None and lazy:
+        waveforms = uproot.lazy({filename: 'DataTree'},
+                                filter_name='waveforms',
+                                step_size=step_size)['waveforms']
+        return waveform_container(settings=settings, waveforms=waveforms)
+      elif sample_slice is None:
+        waveforms = tree['waveforms'].array()
+      else:
+        waveforms = awkward.concatenate([
+          chunk['waveforms'][:, sample_slice]
+          for chunk in tree.iterate(['waveforms'], step_size=step_size)
+        ])
+      waveforms, dense = _densify(waveforms)
+
+      container = waveform_container(settings=settings,
+                                     waveforms=waveforms,
+                                     sample_slice=sample_slice)
+      container._set_waveforms_np(dense)
+      return container
+
+  def save_to_file(
+      self,
+      filename: str,
+      compression: uproot.compression.Compression = uproot.ZLIB(1),
+      step_size: int = 100000,
+  ) -> None:
     """
-    Saving the waveform to root.
+    Saving the waveform to root. The compression defaults to the uproot default
+    of ZLIB level 1, batch conversions can use `uproot.LZ4(4)` for faster
+    writes. The waveforms are written in baskets of `step_size` events, so that
+    only one basket needs to be converted and compressed at once, and lazily
+    read waveforms are only read one basket at a time.
     """
-    with uproot.recreate(filename) as f:
+    with uproot.recreate(filename, compression=compression) as f:
       f['run_info/readout'] = {
         k: numpy.array([v])
         for k, v in self.settings.__dict__.items()
       }
-      f['DataTree'] = {'waveforms': self.waveforms}
+      nevents = len(self.waveforms)
+      f['DataTree'] = {'waveforms': self.waveforms[:step_size]}
+      for start in range(step_size, nevents, step_size):
+        f['DataTree'].extend(
+          {'waveforms': self.waveforms[start:start + step_size]})
@@ -7,7 +7,12 @@ styling methods.
 
 """
 from typing import Tuple, Union, Optional
-from decimal import Decimal
+import functools
+import math
+import os
+import warnings
+import weakref
+from collections import OrderedDict
 
 import matplotlib as matplot
 import mplhep
@@ -18,6 +23,13 @@ import boost_histogram
 import numpy as np
 import zfit
 
+# Setting SIPMANALYZE_FAST_PLOTS=1 disables the automatic y-axis rescaling in
+# add_std_label by default, which redraws the canvas and dominates the run time
+# of batch plot generation. The usual false strings (0, false, no, off) and an
+# empty value keep the rescaling enabled.
+FAST_PLOTS = os.environ.get('SIPMANALYZE_FAST_PLOTS', '').strip().lower() \
+  not in ('', '0', 'false', 'no', 'off')
+
 
 def make_simple_figure():
   """
@@ -73,18 +85,43 @@ def make_2d_figure():
   return fig, ax
 
 
+@functools.singledispatch
+def _to_hist(data, binning: int = 40, prange=None):
+  """
+  Casting the supported data containers to a hist.BaseHist object, so the
+  plotting helpers only need to handle a single data type. Unsupported data
+  types (including None) are returned as None. The binning and prange are only
+  used for unbinned data.
+  """
+  return None
+
+
+@_to_hist.register(hist.BaseHist)
+def _hist_to_hist(data, binning: int = 40, prange=None):
+  return data
+
+
+@_to_hist.register(zfit._data.binneddatav1.BinnedData)
+def _binned_to_hist(data, binning: int = 40, prange=None):
+  return data.to_hist()
+
+
+@_to_hist.register(zfit.core.data.Data)
+def _unbinned_to_hist(data, binning: int = 40, prange=None):
+  return unbinned_to_binned(data, binning, prange=prange)
+
+
 def _get_range1d(pdf, data=None, prange=None):
   """Getting the 1D plotting range"""
   if prange is not None:
     return prange  # Custom range
-  elif data is not None:
-    if isinstance(data, zfit.core.data.Data):
-      return tuple(data.data_range.limit1d)
-    elif isinstance(data, zfit._data.binneddatav1.BinnedData):
-      return tuple(data.data_range.limit1d)
-    elif isinstance(data, hist.BaseHist):
-      return data.axes[0]
+  elif isinstance(data, zfit.core.data.Data):
+    return tuple(data.data_range.limit1d)  # Does not require binning
 
+  h = _to_hist(data)
+  if h is not None:
+    edges = h.axes[0].edges
+    return (edges[0], edges[-1])
   else:
     return tuple(pdf._space.limit1d)
 
@@ -104,18 +141,28 @@ def _get_norm1d(prange, data=None) -> float:
   """
   if data is None:
     return 1.0
-  elif isinstance(data, zfit._data.binneddatav1.BinnedData):
-    # Binned data set in zfit, casting to hist to typical conversion
-    return _get_norm1d(prange, data.to_hist())
-  elif isinstance(data, hist.BaseHist):
+  data = _to_hist(data)
+  if data is not None:
     assert len(data.axes) == 1, "Only 1 dimensional histograms allowed!"
+    axis = data.axes[0]
+    if isinstance(axis, hist.axis.Regular) and axis.transform is None:
+      # Getting the sum of weights of the bins from the one containing the
+      # lower limit up to (excluding) the one containing the upper limit, the
+      # bin index is directly calculated from the linear edges (transformed
+      # axes use the slicing below).
+      lo, hi = axis.edges[0], axis.edges[-1]
+      i0, i1 = np.clip(
+        np.floor((np.asarray(prange, dtype=float) - lo) / (hi - lo) *
+                 len(axis)), 0, len(axis)).astype(int)
+      s = data.values()[i0:i1].sum()
+      return s * np.mean(axis.widths)
+
     # Getting the sum of weights
     s = data[prange[0] * 1j:prange[1] * 1j:sum]
     if isinstance(s, boost_histogram.accumulators.WeightedSum):
       s = s['value']
-    if isinstance(data.axes[0], hist.axis.Regular):
-      s = s * np.mean(data.axes.widths[0])
-
+    if isinstance(axis, hist.axis.Regular):
+      s = s * np.mean(axis.widths)
     return s
 
   warnings.warn(
@@ -131,15 +178,120 @@ def unbinned_to_binned(data, binning, prange=None):
   raise NotImplementedError('Not implement!')
 
 
-def _calc_pdf_arrays(x, pdf, data, prange=None, binning: int = 40):
-  if isinstance(data, zfit.data.Data):
-    data = unbinned_to_binned(data, binning, prange=prange)
-    return _calc_pdf_arrays(x, pdf, data, prange=prange, binning=binning)
+# Compiled PDF evaluation functions, one per PDF object
+_pdf_eval_cache = weakref.WeakKeyDictionary()
+
+# Last few PDF evaluation results, so that the same PDF is not evaluated again
+# on the same points when plotting the PDF and the fit ratio of a single fit
+_PDF_VALUE_CACHE_SIZE = 4
+_pdf_value_cache = OrderedDict()
+
+
+def _plot_cache_clear():
+  """Clearing the cached PDF evaluation functions and results"""
+  _pdf_eval_cache.clear()
+  _pdf_value_cache.clear()
+
+
+def _param_limits(pdf):
+  """Limits of all parameters of the PDF, used to detect stale compilations"""
+  def limit(p, attr):
+    v = getattr(p, attr, None)
+    return None if v is None else float(v)
+
+  return tuple(
+    sorted((p.name, limit(p, 'lower'), limit(p, 'upper'))
+           for p in pdf.get_params(floating=None)))
+
+
+def _param_values(pdf):
+  """Current values of all parameters of the PDF"""
+  return tuple(
+    sorted((p.name, float(p.value())) for p in pdf.get_params(floating=None)))
+
+
+def _eval_pdf(pdf, x):
+  """
+  Evaluating the PDF at the points x as a numpy array.
+
+  The evaluation is compiled once per PDF object and reused for subsequent
+  plots, calling `pdf.pdf` directly pays the zfit input handling on every call.
+  Parameter values are read when the function is called, so the cached function
+  follows changes to the parameter values. The parameter limits are fixed in the
+  compiled function, so it is recompiled if any of the limits changed (as
+  happens in `estimate.run_iterative_pdf_fit`).
+
+  The results of the last few evaluations are also kept, keyed by the PDF, the
+  parameter values and limits, and the evaluation points, so repeated plotting
+  of the same fit result does not evaluate the PDF again. Use
+  `_plot_cache_clear` to drop the cached functions and results.
+  """
+  x = np.ascontiguousarray(x, dtype=np.float64)
+  limits = _param_limits(pdf)
+  try:
+    cached_limits, func = _pdf_eval_cache.get(pdf, (None, None))
+  except TypeError:  # PDF objects that cannot be weakly referenced
+    return np.asarray(pdf.pdf(x))
+  if func is None or cached_limits != limits:
+    pdf_ref = weakref.ref(pdf)  # The cache should not keep the PDF alive
+    func = zfit.z.function(lambda v: pdf_ref().pdf(v))
+    _pdf_eval_cache[pdf] = (limits, func)
+
+  key = (id(pdf), limits, _param_values(pdf), x.shape, x.tobytes())
+  if key in _pdf_value_cache:
+    pdf_ref, y = _pdf_value_cache[key]
+    if pdf_ref() is pdf:  # Guarding against reused ids of deleted PDFs
+      _pdf_value_cache.move_to_end(key)
+      return y.copy()
+  y = np.asarray(func(x))
+  _pdf_value_cache[key] = (weakref.ref(pdf), y.copy())
+  while len(_pdf_value_cache) > _PDF_VALUE_CACHE_SIZE:
+    _pdf_value_cache.popitem(last=False)
+  return y
+
+
+def _calc_pdf_arrays(x, pdf, norm: float = 1.0):
+  """PDF values at x, scaled by the normalization factor"""
+  return _eval_pdf(pdf, x) * norm
+
+
+def _pdf_grid(pdf, prange, num: int, log: bool = False, max_peaks: int = 16):
+  """
+  Points to evaluate the PDF at for plotting.
+
+  SiPM response PDFs vary the most around the pedestal and the photo-electron
+  peaks at `pedestal + k * gain`, so if the PDF has parameters with these names,
+  half of the `num` points are spread evenly over the range, and the other half
+  are split between the first `max_peaks` peaks within the range, covering a
+  quarter of the gain on either side of each peak. Otherwise all points are
+  spread evenly. For a log x axis with a positive range, the even points are
+  log-spaced instead.
+  """
+  lo, hi = float(prange[0]), float(prange[1])
+  params = {p.name: p for p in pdf.get_params(floating=None)}
+  peaks = np.empty(0)
+  if 'pedestal' in params and 'gain' in params:
+    pedestal = float(params['pedestal'].value())
+    gain = float(params['gain'].value())
+    if gain > 0:
+      k0 = max(np.ceil((lo - pedestal) / gain), 0)
+      k = np.arange(k0, k0 + max_peaks)
+      peaks = pedestal + k * gain
+      peaks = peaks[peaks <= hi]
+
+  nbase = num if len(peaks) == 0 else num // 2
+  if log and lo > 0:
+    base = np.geomspace(lo, hi, num=nbase)
   else:
-    y = pdf.pdf(x)  # Regular PDF calculations
-    y = y * _get_norm1d(prange, data)  # Scaling to data
-    return y
-  pass
+    base = np.linspace(lo, hi, num=nbase)
+  if len(peaks) == 0:
+    return base
+
+  npeak = max((num - nbase) // len(peaks), 2)
+  w = np.linspace(-0.25, 0.25, num=npeak) * gain
+  dense = (peaks[:, None] + w[None, :]).ravel()
+  dense = dense[(dense >= lo) & (dense <= hi)]
+  return np.unique(np.concatenate([base, dense]))
 
 
 def plot_pdf1d(ax,
@@ -148,6 +300,7 @@ def plot_pdf1d(ax,
                scale: float = 1,
                prange: Optional[Tuple[int, int]] = None,
                binning: int = 40,
+               num: int = 800,
                **kwargs):
   """
   Plotting a zfit pdf model onto a canvas. Data is here to matched the
@@ -174,27 +327,24 @@ def plot_pdf1d(ax,
   binning : int, optional
       Number of bins used use when extracting normalization from unbinned data.
       Notice that only regular binning will be used in this case.
+  num : int, optional
+      Approximate number of points the PDF is evaluated at. Half of the points
+      are spread evenly over the plot range (log-spaced for log x axes), the
+      other half are placed around the photo-electron peaks if the PDF has
+      `pedestal` and `gain` parameters, see `_pdf_grid`.
 
   Returns
   -------
   returns the x,y numpy arrays used to plot the PDF function.
   """
-  if isinstance(data, zfit.data.Data):
-    ## Processing required for unbinned data,
-    data = unbinned_to_binned(data, binning, prange=prange)
-    return plot_pdf1d(ax=ax,
-                      pdf=pdf,
-                      data=data,
-                      scale=scale,
-                      prange=prange,
-                      **kwargs)
-  else:
-    prange = _get_range1d(pdf, data, prange)
-    x = np.linspace(prange[0], prange[1], num=2000)
-    y = _calc_pdf_arrays(x, pdf, data, prange)  # Regular PDF calculations
-    y = y * scale  # Additional scale factor
-    ax.plot(x, y, **kwargs)  # Running the plot
-    return x, y
+  if data is not None:
+    data = _to_hist(data, binning, prange=prange)
+  prange = _get_range1d(pdf, data, prange)
+  x = _pdf_grid(pdf, prange, num, log=ax.get_xscale() == 'log')
+  norm = _get_norm1d(prange, data) * scale  # Scaling to data + additional
+  y = _calc_pdf_arrays(x, pdf, norm)
+  ax.plot(x, y, **kwargs)  # Running the plot
+  return x, y
 
 
 def _calc_density_hist(h):
@@ -215,14 +365,10 @@ def plot_data1d(ax, data, **kwargs):
   instead, where each of the bin entries is divided by the bin width, that way,
   the histogram is ensured to have reliable scaling with data.
   """
-  if isinstance(data, zfit.data.Data):
-    binned_data = unbinned_to_binned(data,
-                                     binning=kwargs.pop('binning'),
-                                     prange=kwargs.pop('prange'))
-    return plot_data1d(ax, binned_data)
-  elif isinstance(data, zfit._data.binneddatav1.BinnedData):
-    return plot_data1d(ax, data.to_hist())
-  elif isinstance(data, hist.Hist):
+  data = _to_hist(data,
+                  binning=kwargs.pop('binning', 40),
+                  prange=kwargs.pop('prange', None))
+  if data is not None:
     assert len(data.axes) == 1, "Can only plot 1d histograms"
     if isinstance(data.axes[0], hist.axis.Regular):
       pdata = data
@@ -237,26 +383,32 @@ def plot_fitratio(ax, num, den, prange=None, **kwargs):
   """
   Plotting the fit results ratio comparison.
   """
-  pnum = num.copy()  # Making a copy of the histogram
+  num = _to_hist(num)
+  values = num.values()
 
   # Getting the Poisson uncertainties
-  p_lo, p_up = hist.intervals.poisson_interval(pnum.values(), pnum.variances())
-  p_lo = pnum.values() - p_lo
-  p_up = p_up - pnum.values()
+  p_lo, p_up = hist.intervals.poisson_interval(values, num.variances())
+  p_lo = values - p_lo
+  p_up = p_up - values
 
   # Modifying the range
   prange = _get_range1d(den, data=num, prange=prange)
 
   # Getting the relevant pdf values
-  x = pnum.axes[0].centers
-  y = _calc_pdf_arrays(x, den, num, prange)
+  x = num.axes[0].centers
+  y = _calc_pdf_arrays(x, den, _get_norm1d(prange, num))
+
+  # Scaling values and uncertainties within range in a single pass
+  ratio = np.stack([values, p_lo, p_up]) / y
+  ratio[0, (x < prange[0]) | (x > prange[1])] = np.nan
 
-  # Scaling values within range
-  pnum.values()[:] = np.where((x >= prange[0]) & (x <= prange[1]),
-                              pnum.values() / y, np.nan)
+  # The ratio is stored in a fresh histogram with the same axes, rather than a
+  # copy of the input histogram that is then overwritten
+  pnum = hist.Hist(*num.axes)
+  pnum.view()[:] = ratio[0]
 
   # Running the plot call
-  mplhep.histplot(pnum, ax=ax, yerr=[p_lo / y, p_up / y], **kwargs)
+  mplhep.histplot(pnum, ax=ax, yerr=ratio[1:], **kwargs)
   return pnum
 
 
@@ -283,8 +435,16 @@ def number_str(central: float,
   $\times10^{n}$ will be added to the string.
   """
   def b10_exp_single(number):
-    (sign, digits, exponent) = Decimal(number).as_tuple()
-    return len(digits) + exponent - 1
+    number = abs(float(number))
+    if number == 0:
+      return 0
+    exp = math.floor(math.log10(number))
+    # Correcting for the rounding of log10 just below powers of 10
+    if 10.0**exp > number:
+      exp -= 1
+    elif exp < 308 and 10.0**(exp + 1) <= number:
+      exp += 1
+    return exp
 
   def b10_exp(*args):
     return tuple(b10_exp_single(x) for x in args)
@@ -348,9 +508,15 @@ def number_str(central: float,
       return s
 
 
-def add_std_label(ax, label=None, **kwargs):
+def add_std_label(ax, label=None, autoscale: Optional[bool] = None, **kwargs):
   """
   Typical labels to be added onto the plot. Borrowing the CMS format for now.
+
+  If `autoscale` is true, the y axis is rescaled to fit the legend and text
+  boxes. This triggers the canvas to be redrawn, so it can be turned off for
+  batch plotting. If not given, it is enabled unless the module level
+  `FAST_PLOTS` flag (set by the SIPMANALYZE_FAST_PLOTS environment variable) is
+  set.
   """
   kwargs.setdefault('loc', 2)  # Top left corner multiline
   kwargs.setdefault('rlabel', '(Light source)')
@@ -362,6 +528,11 @@ def add_std_label(ax, label=None, **kwargs):
   except:
     pass
 
+  if autoscale is None:
+    autoscale = not FAST_PLOTS
+  if not autoscale:
+    return ax
+
   # Automatically scaling the axis according to legend
   if ax.legend_ is not None:
     try: